@@ -7,6 +7,9 @@ toasters.py - Flying Toasters(ish) for Raspberry Pi Pico with Waveshare Pico LCD
     Convert spritesheet bmp to tft.bitmap() method compatible python module using:
         python3 ./sprites2bitmap.py toasters.bmp 64 64 4 > toast_bitmaps.py
 
+    The bitmaps are rendered to RGB565 framebuffers at startup and composed in RAM so each
+    sprite and the area it uncovered are sent to the display with a single blit_buffer.
+
     Video: https://youtu.be/9W51gukpQus
 
 '''
@@ -14,120 +17,288 @@ toasters.py - Flying Toasters(ish) for Raspberry Pi Pico with Waveshare Pico LCD
 import gc
 import time
 import random
+from micropython import const
 from machine import Pin, SPI
+import framebuf
 import st7789
 import toast_bitmaps
 
-TOASTER_FRAMES = [0, 1, 2, 3]
-TOAST_FRAMES = [4]
+# display size after rotation and the size of the toast_bitmaps sprites, if the bitmaps
+# change size these must be changed to match.
+TFT_W = const(320)
+TFT_H = const(240)
+W = const(64)
+H = const(64)
+
+# largest region that can be composed in RAM, a sprite and the area it uncovered when moving
+REGION_W = const(72)
+REGION_H = const(72)
+
+TOASTER_FRAMES = (0, 1, 2, 3)
+TOAST_FRAMES = (4,)
+
+# getrandbits is much cheaper than randint, the slight bias is fine for sprite placement
+_gr = random.getrandbits
 
-def collide(a_col, a_row, a_width, a_height, b_col, b_row, b_width, b_height):
-    '''return true if two rectangles overlap'''
-    return (a_col + a_width >= b_col and a_col <= b_col + b_width
-            and a_row + a_height >= b_row and a_row <= b_row + b_height)
+# alternates the edge random_start tries, the side a sprite enters from doesn't need to be random
+_toggle = 0
 
-def random_start(tft, sprites, bitmaps, num):
+# all sprites kept sorted by column for the sweep and prune collision checks
+sprites_by_x = []
+
+class DirtyRects():
+    '''
+    Track the rectangles of the screen that need to be erased. Rectangles that overlap or touch
+    are merged into one so each part of the screen is only filled once.
     '''
-    Return a random location along the top or right of the screen, if that location would overlaps
-    with another sprite return (0,0). This allows the other sprites to keep moving giving the next
-    random_start a better chance to avoid a collision.
+    def __init__(self):
+        self.rects = []
+
+    def mark(self, col, row, width, height):
+        '''mark a rectangle as dirty, merging it with the dirty rectangles it touches'''
+        rects = self.rects
+        right = col + width
+        bottom = row + height
+        index = 0
+        while index < len(rects):
+            rect_col, rect_row, rect_right, rect_bottom = rects[index]
+            if (col <= rect_right and rect_col <= right
+                    and row <= rect_bottom and rect_row <= bottom):
+                col = min(col, rect_col)
+                row = min(row, rect_row)
+                right = max(right, rect_right)
+                bottom = max(bottom, rect_bottom)
+                rects.pop(index)
+
+                # the merged rectangle may now touch one that was already checked
+                index = 0
+            else:
+                index += 1
+
+        rects.append((col, row, right, bottom))
+
+    def flush(self, tft, color):
+        '''
+        Fill the dirty rectangles with color, one fill_rect for each. The last locations of
+        three sprites can never cover half of the screen, so there is no full screen fill.
+        '''
+        rects = self.rects
+        if not rects:
+            return
 
+        for col, row, right, bottom in rects:
+            tft.fill_rect(col, row, right - col, bottom - row, color)
+
+        self.rects = []
+
+def render_frames(bitmaps):
+    '''
+    Return a tuple of RGB565 framebuffers, one for each bitmap in a 4 bits per pixel bitmap
+    module. The palette colors are already byte swapped for the display and framebuf stores
+    pixels little endian, so the buffers can be sent to the display as they are.
+    '''
+    palette = bitmaps.PALETTE
+    bitmap = bitmaps.BITMAP
+    size = bitmaps.WIDTH * bitmaps.HEIGHT
+    frames = []
+    for index in range(bitmaps.BITMAPS):
+        buffer = bytearray(size * 2)
+        offset = 0
+        for byte in bitmap[index * size // 2:(index + 1) * size // 2]:
+            color = palette[byte >> 4]
+            buffer[offset] = color & 0xff
+            buffer[offset + 1] = color >> 8
+            color = palette[byte & 0x0f]
+            buffer[offset + 2] = color & 0xff
+            buffer[offset + 3] = color >> 8
+            offset += 4
+
+        frames.append(
+            framebuf.FrameBuffer(buffer, bitmaps.WIDTH, bitmaps.HEIGHT, framebuf.RGB565))
+
+    return tuple(frames)
+
+class Compositor():
+    '''
+    Compose the sprites overlapping a region of the screen in a RAM buffer so the region can be
+    sent to the display with a single blit_buffer.
+    '''
+    def __init__(self, tft, bitmaps):
+        self.tft = tft
+        self.frames = render_frames(bitmaps)
+        self.buffer = bytearray(REGION_W * REGION_H * 2)
+        self.framebuffers = {}
+
+    def framebuffer(self, width, height):
+        '''return a framebuffer of width by height pixels using the shared buffer'''
+        key = width << 8 | height
+        fb = self.framebuffers.get(key)
+        if fb is None:
+            fb = framebuf.FrameBuffer(self.buffer, width, height, framebuf.RGB565)
+            self.framebuffers[key] = fb
+
+        return fb
+
+    def draw(self, sprites, col, row, width, height):
+        '''draw a black region with every sprite that overlaps it in z-order'''
+        fb = self.framebuffer(width, height)
+        fb.fill(0)
+        right = col + width
+        bottom = row + height
+        frames = self.frames
+        for sprite in sprites:
+            sprite_col = sprite.col
+            sprite_row = sprite.row
+            if (sprite_col and sprite_row
+                    and sprite_col < right and sprite_col + W > col
+                    and sprite_row < bottom and sprite_row + H > row):
+                fb.blit(frames[sprite.frames[sprite.step]], sprite_col - col, sprite_row - row)
+
+        self.tft.blit_buffer(self.buffer, col, row, width, height)
+
+def sort_by_col(sprites):
+    '''insertion sort sprites by column, O(n) since the sprites are almost always in order'''
+    for i in range(1, len(sprites)):
+        sprite = sprites[i]
+        col = sprite.col
+        j = i - 1
+        while j >= 0 and sprites[j].col > col:
+            sprites[j + 1] = sprites[j]
+            j -= 1
+        sprites[j + 1] = sprite
+
+def random_start(toast):
     '''
-    # 50/50 chance to try along the top/right half or along the right/top half of the screen
-    if random.getrandbits(1):
+    Move toast to a random location along the top or right of the screen, if that location would
+    overlap with another sprite move it to (0,0). This allows the other sprites to keep moving
+    giving the next random_start a better chance to avoid a collision.
+
+    '''
+    global _toggle
+
+    # alternate between trying along the top/right half or along the right/top half of the screen
+    _toggle ^= 1
+    if _toggle:
         row = 1
-        col = random.randint(bitmaps.WIDTH//2, tft.width()-bitmaps.WIDTH)
+        col = W//2 + _gr(8) % (TFT_W - W - W//2 + 1)
     else:
-        col = tft.width() - bitmaps.WIDTH
-        row = random.randint(1, tft.height() // 2)
+        col = TFT_W - W
+        row = 1 + _gr(7) % (TFT_H // 2)
+
+    # only check the sprites with columns that could overlap, sprites_by_x is sorted by column
+    right = col + W
+    bottom = row + H
+    for sprite in sprites_by_x:
+        sprite_col = sprite.col
+        if sprite_col > right:
+            break
+
+        sprite_row = sprite.row
+        if (sprite is not toast
+                and col <= sprite_col + W
+                and bottom >= sprite_row
+                and row <= sprite_row + H):
+
+            col = 0
+            row = 0
+            break
+
+    toast.col = col
+    toast.row = row
 
-    if any(collide(
-        col, row, bitmaps.WIDTH, bitmaps.HEIGHT,
-        sprite.col, sprite.row, sprite.width, sprite.height)
-        for sprite in sprites if num != sprite.num):
+def main():
 
-        col = 0
-        row = 0
+    # configure spi interface, use a slow clock while the display is initialized
+    spi = SPI(1, baudrate=10000000, sck=Pin(10), mosi=Pin(11))
 
-    return (col, row)
+    # initialize display
+    tft = st7789.ST7789(
+        spi,
+        240,
+        320,
+        reset=Pin(12, Pin.OUT),
+        cs=Pin(9, Pin.OUT),
+        dc=Pin(8, Pin.OUT),
+        backlight=Pin(13, Pin.OUT),
+        rotation=1)
 
-def main():
+    # init display then switch to the fastest spi clock the Pico supports for drawing, the
+    # display is write only so it can't be checked. If the display shows garbled pixels lower
+    # this to 40000000.
+    tft.init()
+    spi.init(baudrate=62500000)
+
+    # clear screen
+    tft.fill(st7789.BLACK)
 
     class Toast():
         '''
         Toast class to keep track of toaster and toast sprites
         '''
-        def __init__(self, sprites, bitmaps, frames):
+        def __init__(self, frames):
             '''create new sprite in random location that does not overlap other sprites'''
-            self.num = len(sprites)
-            self.bitmaps = bitmaps
             self.frames = frames
             self.steps = len(frames)
-            self.col, self.row  = random_start(tft, sprites, bitmaps, self.num)
-            self.width = bitmaps.WIDTH
-            self.height = bitmaps.HEIGHT
+            random_start(self)
             self.last_col = self.col
             self.last_row = self.row
             self.step = random.randint(0, self.steps)
-            self.dir_col = -random.randint(2, 5)
+            self.dir_col = -(2 + (_gr(2) & 3))
             self.dir_row = 2
             self.prev_dir_col = self.dir_col
             self.prev_dir_row = self.dir_row
             self.iceberg = 0
+            sprites_by_x.append(self)
+            sort_by_col(sprites_by_x)
 
-        def clear(self):
-            '''clear above and behind sprite'''
-            tft.fill_rect(
-                self.col, self.row-1, self.width, self.dir_row+1,
-                st7789.BLACK)
-
-            tft.fill_rect(
-                self.col+self.width+self.dir_col, self.row,
-                -self.dir_col, self.height, st7789.BLACK)
-
-        def erase(self):
-            '''erase last postion of sprite'''
-            tft.fill_rect(
-                self.last_col, self.last_row, self.width, self.height, st7789.BLACK)
-
-        def move(self, sprites):
+        def move(self):
             '''step frame and move sprite'''
+            col = self.col
+            row = self.row
 
             if self.steps:
                 self.step = (self.step + 1) % self.steps
 
-            self.last_col = self.col
-            self.last_row = self.row
-            new_col = self.col + self.dir_col
-            new_row = self.row + self.dir_row
-
-            # if new location collides with another sprite, change direction for 32 frames
-            # if new location collides with another sprite, change direction for 32 frames
-
-            for sprite in sprites:
-                if (
-                    self.num != sprite.num
-                    and collide(
-                        new_col, new_row, self.width, self.height,
-                        sprite.col, sprite.row, sprite.width, sprite.height,
-                    )
-                    and (self.col > sprite.col)):
+            self.last_col = col
+            self.last_row = row
+            new_col = col + self.dir_col
+            new_row = row + self.dir_row
+
+            # if new location collides with another sprite to the left, change direction for
+            # 32 frames. Scan back through the sprites sorted by column until they are too far
+            # left to overlap the new location.
+
+            index = sprites_by_x.index(self)
+            while index:
+                index -= 1
+                sprite = sprites_by_x[index]
+                sprite_col = sprite.col
+                if sprite_col + W < new_col:
+                    break
+
+                sprite_row = sprite.row
+                if (sprite_col < col
+                        and new_col + W >= sprite_col
+                        and new_row + H >= sprite_row
+                        and new_row <= sprite_row + H):
 
                     self.iceberg = 32
                     self.dir_col = -1
                     self.dir_row = 3
-                    new_col = self.col + self.dir_col
-                    new_row = self.row + self.dir_row
+                    new_col = col + self.dir_col
+                    new_row = row + self.dir_row
 
             self.col = new_col
             self.row = new_row
 
-            # if new location touches edge of screen, erase then set new start location
-            if self.col <= 0 or self.row > tft.height() - self.height:
-                self.erase()
-                self.dir_col = -random.randint(2, 5)
+            # if new location touches edge of screen, set new start location, the last
+            # location will be erased by draw()
+            if new_col <= 0 or new_row > TFT_H - H:
+                self.dir_col = -(2 + (_gr(2) & 3))
                 self.dir_row = 2
-                self.col, self.row  = random_start(tft, sprites, self.bitmaps, self.num)
+                random_start(self)
+
+            sort_by_col(sprites_by_x)
 
             # Track post collision direction change
             if self.iceberg:
@@ -136,48 +307,77 @@ def main():
                     self.dir_col = self.prev_dir_col
                     self.dir_row = self.prev_dir_row
 
-        def draw(self):
-            '''if the location is not 0,0 draw current frame of sprite at it's location'''
+        def erase(self, dirty):
+            '''
+            Set the region of the screen to draw the sprite in. If the last location can be
+            composed with the new location the region covers both, otherwise the last
+            location is marked as dirty and the region is just the new location.
+            '''
+            col = self.col
+            row = self.row
+            last_col = self.last_col
+            last_row = self.last_row
+            self.region_col = col
+            self.region_row = row
+            self.region_width = W
+            self.region_height = H
+
+            if not (last_col and last_row):
+                return
+
+            region_col = min(col, last_col)
+            region_row = min(row, last_row)
+            region_width = max(col, last_col) + W - region_col
+            region_height = max(row, last_row) + H - region_row
+
+            # one window of at most 72x72 pixels costs less than erasing the last location
+            # and drawing the new one in two windows of 64x64, so always compose both
+            # locations when they fit in the buffer.
+            if not (col and row) or region_width > REGION_W or region_height > REGION_H:
+                dirty.mark(last_col, last_row, W, H)
+            else:
+                self.region_col = region_col
+                self.region_row = region_row
+                self.region_width = region_width
+                self.region_height = region_height
+
+        def draw(self, compositor, sprites):
+            '''if the location is not 0,0 draw the sprite's region of the screen'''
             if self.col and self.row:
-                tft.bitmap(self.bitmaps, self.col, self.row, self.frames[self.step])
-
-    # configure spi interface
-        # configure spi interface
-    spi = SPI(1, baudrate=31250000, sck=Pin(10), mosi=Pin(11))
-
-    # initialize display
-    tft = st7789.ST7789(
-        spi,
-        240,
-        320,
-        reset=Pin(12, Pin.OUT),
-        cs=Pin(9, Pin.OUT),
-        dc=Pin(8, Pin.OUT),
-        backlight=Pin(13, Pin.OUT),
-        rotation=1,
-        buffer_size=64*64*2)
-
-    # init and clear screen
-    tft.init()
-    tft.fill(st7789.BLACK)
+                compositor.draw(
+                    sprites, self.region_col, self.region_row,
+                    self.region_width, self.region_height)
 
     # create toast spites and set animation frames
-    sprites = []
-    sprites.append(Toast(sprites, toast_bitmaps, TOAST_FRAMES))
-    sprites.append(Toast(sprites, toast_bitmaps, TOASTER_FRAMES))
-    sprites.append(Toast(sprites, toast_bitmaps, TOASTER_FRAMES))
+    sprites = (
+        Toast(TOAST_FRAMES),
+        Toast(TOASTER_FRAMES),
+        Toast(TOASTER_FRAMES))
 
     stop = Pin(15, Pin.IN, Pin.PULL_UP)      # Top Left
 
     # move and draw sprites until stop button is pressed
 
+    # parts of the screen that need to be erased before the sprites are drawn
+    dirty = DirtyRects()
+    compositor = Compositor(tft, toast_bitmaps)
+
+    frame_count = 0
     while stop.value():
         for sprite in sprites:
-            sprite.clear()
-            sprite.move(sprites)
-            sprite.draw()
+            sprite.move()
+            sprite.erase(dirty)
+
+        # erase the dirty rectangles then draw the region of each sprite over them
+        dirty.flush(tft, st7789.BLACK)
+        for sprite in sprites:
+            sprite.draw(compositor, sprites)
+
+        # the frame loop allocates almost nothing, only collect every 128 frames
+        frame_count = (frame_count + 1) & 127
+        if frame_count == 0:
+            gc.collect()
 
-        gc.collect()
         time.sleep(0.01)
 
 main()
@@ -22,7 +22,7 @@ import st7789
 import pacifico60 as font
 
 rtc = RTC()
-background_lock = 0     # prevents background change while > 0
+background_lock = 0     # prevents background change for this many seconds while > 0
 
 class Button:
     """
@@ -33,29 +33,86 @@ class Button:
     def __init__(self, pin, callback, trigger=Pin.IRQ_FALLING, debounce=350):
         self.callback = callback
         self.debounce = debounce
+        self._ticks_ms = utime.ticks_ms
         self._next_call = utime.ticks_ms() + self.debounce
         pin.irq(trigger=trigger, handler=self.debounce_handler)
 
-    def call_callback(self, pin):
-        self.callback(pin)
-
     def debounce_handler(self, pin):
-        if utime.ticks_ms() > self._next_call:
-            self._next_call = utime.ticks_ms() + self.debounce
-            self.call_callback(pin)
+        ticks = self._ticks_ms()
+        if ticks > self._next_call:
+            self._next_call = ticks + self.debounce
+            self.callback(pin)
 
 def hour_pressed(pin):
     global background_lock, rtc
     tm = rtc.datetime()
     rtc.init((tm[0], tm[1], tm[2], tm[3], tm[4], tm[5]+1, tm[6], tm[7]))
-    background_lock = 10
+    background_lock = 5
 
 def minute_pressed(pin):
     global background_lock, rtc
     tm = rtc.datetime()
     rtc.init((tm[0], tm[1], tm[2], tm[3], tm[4]+1, tm[5], tm[6], tm[7]))
-    background_lock = 10
+    background_lock = 5
+
+def crop(bitmap, bitmap_width, col, background):
+    """
+    Copy the columns starting at col of a color565 bitmap buffer bitmap_width pixels
+    wide into an existing (buffer, width, height) background tuple.
+    """
+    buffer, width, _ = background
+    source = memoryview(bitmap)
+    row_bytes = width * 2
+    start = col * 2
+    end = start + row_bytes
+    stride = bitmap_width * 2
+
+    for row in range(0, len(buffer), row_bytes):
+        buffer[row:row + row_bytes] = source[start:end]
+        start += stride
+        end += stride
+
+def glyph_width(char):
+    """
+    Return the width in pixels of char in the font
+    """
+    return font.WIDTHS[font.MAP.index(char)]
 
+def render(char, background, color, glyph):
+    """
+    Draw char in color over the (buffer, width, height) background into an existing
+    (buffer, width, height) glyph tuple the same way tft.write draws it without fill.
+    """
+    index = font.MAP.index(char)
+    buffer, width, _ = glyph
+    bit = 0
+    for i in range(font.OFFSET_WIDTH):
+        bit = bit << 8 | font.OFFSETS[index * font.OFFSET_WIDTH + i]
+
+    bpp = font.BPP
+    bitmaps = font.BITMAPS
+    back, back_width, _ = background
+    color_hi = color >> 8
+    color_lo = color & 0xff
+    offset = 0
+
+    for row in range(font.HEIGHT):
+        back_offset = row * back_width * 2
+        for _ in range(width):
+            pixel = 0
+            for _ in range(bpp):
+                pixel |= bitmaps[bit >> 3] & (0x80 >> (bit & 7))
+                bit += 1
+
+            if pixel:
+                buffer[offset] = color_hi
+                buffer[offset + 1] = color_lo
+            else:
+                buffer[offset] = back[back_offset]
+                buffer[offset + 1] = back[back_offset + 1]
+
+            offset += 2
+            back_offset += 2
 
 def main():
     """
@@ -86,17 +143,46 @@ def main():
         ('7.jpg', 30, 50, st7789.WHITE),
         ('8.jpg', 30, 50, st7789.WHITE)]
 
-    digit_columns = []
+    digit_columns = ()
+
+    # allocate the background bitmap behind each clock digit once and reuse them for each
+    # background image so changing the background does not fragment the heap.
+    digit_background = tuple(
+        (bytearray(font.MAX_WIDTH * font.HEIGHT * 2), font.MAX_WIDTH, font.HEIGHT)
+        for _ in range(5))
+
+    # the ':' and ' ' glyphs of the blinking colon are rendered over the colon's background
+    # into these buffers, they are also allocated once and reused for each background image.
+    colon_glyphs = {
+        colon: (bytearray(glyph_width(colon) * font.HEIGHT * 2), glyph_width(colon), font.HEIGHT)
+        for colon in ": "}
+
     background_change = True
     background_counter = 0
     time_col = 0
     time_row = 0
     time_color = 0
-    last_time = "-----"
+    last_time = "----"
+    last_colon = "-"
 
     Button(pin=Pin(35, mode=Pin.IN, pull=Pin.PULL_UP), callback=hour_pressed)
     Button(pin=Pin(0, mode=Pin.IN, pull=Pin.PULL_UP), callback=minute_pressed)
 
+    def write_digit(digit, char):
+        """
+        Draw a changed hour or minute digit over its background, filling the rest of the
+        digit's column with the background so no part of a wider digit is left behind
+        """
+        tft.write(
+            font,                       # the font to write to the display
+            char,                       # time string digit to write
+            digit_columns[digit],       # write to the correct column
+            time_row,                   # write on row
+            time_color,                 # color of time text
+            st7789.BLACK,               # transparent background color
+            digit_background[digit],    # use the background bitmap
+            True)                       # fill to the right of narrower digits
+
     while True:
 
         # create new digit_backgrounds and change the background image
@@ -106,8 +192,6 @@ def main():
             background_counter %= len(backgrounds)
             background_change = False
 
-            # clear the old backgrounds and gc
-            digit_background = []
             gc.collect()
 
             # draw the new background
@@ -119,24 +203,41 @@ def main():
 
             # nudge the ':' to the right since it is narrower then the digits
             digit_columns[2] += font.MAX_WIDTH // 4
+            digit_columns = tuple(digit_columns)
+
+            # decode the strip of the jpg file behind all of the clock digits once
+            strip_width = max(digit_columns) + font.MAX_WIDTH - time_col
+            strip, _, _ = tft.jpg_decode(
+                image,                          # jpg file name
+                time_col,                       # column to start bitmap at
+                time_row,                       # row to start bitmap at
+                strip_width,                    # width of bitmap to save
+                font.HEIGHT)                    # height of bitmap to save
+
+            # copy the background bitmap behind each clock digit out of the strip so it can be
+            # used to write each digit simulating transparency.
+            for digit in range(5):
+                crop(
+                    strip,                      # decoded strip
+                    strip_width,                # width of the strip
+                    digit_columns[digit] - time_col,    # column to start bitmap at
+                    digit_background[digit])    # background to copy the bitmap into
+
+            # free the strip
+            strip = None
+            gc.collect()
 
-            # get the background bitmap behind each clock digit from the jpg file and store it
-            # in a list so it can be used to write each digit simulating transparency.
-            digit_background = [
-                tft.jpg_decode(
-                    image,                      # jpg file name
-                    digit_columns[digit],       # column to start bitmap at
-                    time_row,                   # row to start bitmap at
-                    font.MAX_WIDTH,             # width of bitmap to save
-                    font.HEIGHT)                # height of bitmap to save
-                for digit in range(5)
-            ]
+            # the ':' blinks every second, prerender both glyphs over its background so they can
+            # be drawn with blit_buffer instead of being rasterized by tft.write each time.
+            for colon, glyph in colon_glyphs.items():
+                render(colon, digit_background[2], time_color, glyph)
 
             # cause all digits to be updated
-            last_time = "-----"
+            last_time = "----"
+            last_colon = "-"
 
-        # get the current hour and minute
-        _, _, _, hour, minute, second, _, _ = utime.localtime()
+        # get the current hour, minute and second
+        _, _, _, _, hour, minute, second, _ = rtc.datetime()
 
         # 12 hour time
         if hour == 0:
@@ -144,41 +245,43 @@ def main():
         if hour > 12:
             hour -= 12
 
-        # format time  string as "HH:MM"
-        time_fmt = "{:02d}:{:02d}" if second % 2 == 0 else "{:02d} {:02d}"
-        time = time_fmt.format(hour, minute)
+        # format time string as "HHMM", the ':' is drawn on its own
+        time = "{:02d}{:02d}".format(hour, minute)
 
-        # loop through the time string
-        for digit in range(5):
+        # only check the digits when the time has changed
+        if time != last_time:
+            if time[0] != last_time[0]:
+                write_digit(0, time[0])
 
-            # Check if this digit has changed
-            if time[digit] != last_time[digit]:
-
-                # digit 1 is the hour, change the background every hour
-                # digit 3 is the tens of the minute, change the background every 10 minutes
-                # digit 4 is the ones of the minute, change the background every minute
-                if digit == 1 and last_time[digit] != '-' and background_lock == 0:
+            if time[1] != last_time[1]:
+                # the hour has changed, change the background every hour
+                if last_time[1] != '-' and background_lock == 0:
                     background_change = True
 
-                # draw the changed digit, don't fill to the right
-                # of the ':' because it is always the same width
-                tft.write(
-                    font,                       # the font to write to the display
-                    time[digit],                # time string digit to write
-                    digit_columns[digit],       # write to the correct column
-                    time_row,                   # write on row
-                    time_color,                 # color of time text
-                    st7789.BLACK,               # transparent background color
-                    digit_background[digit],    # use the background bitmap
-                    digit != 2)                 # don't fill to the right of the ':'
-
-        # save the current time
-        last_time = time
+                write_digit(1, time[1])
+
+            if time[2] != last_time[2]:
+                write_digit(3, time[2])
+
+            if time[3] != last_time[3]:
+                write_digit(4, time[3])
+
+            # save the current time
+            last_time = time
+
+        # blink the ':' every second, only drawing it when it changes
+        colon = ":" if second % 2 == 0 else " "
+        if colon != last_colon:
+            buffer, width, height = colon_glyphs[colon]
+            tft.blit_buffer(buffer, digit_columns[2], time_row, width, height)
+            last_colon = colon
 
         if background_lock:
             background_lock -= 1
 
-        utime.sleep(0.5)
         gc.collect()
 
+        # nothing changes until the next second, sleep until then (subseconds are microseconds)
+        utime.sleep_ms(1000 - rtc.datetime()[7] // 1000)
+
 main()